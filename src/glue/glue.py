@@ -1,45 +1,224 @@
 import boto3
+import gzip
 import json
+import math
+import zlib
+from functools import lru_cache
 from datetime import datetime, timedelta
-from decimal import Decimal
 import logging
-from collections import defaultdict
-import io
-
-# Set up logging with string buffer
-logger = logging.getLogger()
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import pandas as pd
+from botocore.config import Config
+
+# Dedicated job logger: it does not propagate to the root logger (which the Glue
+# runtime may already have handlers on), and its handlers are attached only once
+logger = logging.getLogger('glue')
 logger.setLevel(logging.INFO)
-log_buffer = io.StringIO()
+logger.propagate = False
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-buffer_handler = logging.StreamHandler(log_buffer)
-buffer_handler.setLevel(logging.INFO)
-buffer_handler.setFormatter(formatter)
-logger.addHandler(buffer_handler)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
-
-
-# Initialize AWS clients
-dynamodb = boto3.client('dynamodb')
-s3 = boto3.client('s3')
+S3_LOG_HANDLER_NAME = 's3_log'
+
+
+# Parallel scan uses one segment per MB of table data, capped at MAX_SCAN_SEGMENTS
+MAX_SCAN_SEGMENTS = 16
+SCAN_SEGMENT_BYTES = 1 << 20
+
+# KPI files are written concurrently; logs stream to S3 in multipart parts
+MAX_UPLOAD_WORKERS = 16
+LOG_PART_BYTES = 5 * 1024 * 1024
+
 TABLE_NAME = 'TripData'
 S3_BUCKET = 'lab7-stream-project'
 S3_KPI_PREFIX = 'kpi/'
 S3_LOG_PREFIX = 'logs/glue/'
 S3_STATE_KEY = 'state/kpi_state.json'
+# KPI, state and log objects are gzip-compressed and stored with ContentEncoding=gzip
+GZIP_LEVEL = 6
+
+# ISO date with an optional time, fraction and Z or +HH:MM offset
+DROPOFF_DATETIME_PATTERN = (
+    r'\d{4}-\d{2}-\d{2}'
+    r'([T ]([01]\d|2[0-3]):[0-5]\d(:[0-5]\d(\.\d+)?)?(Z|[+-]([01]\d|2[0-3]):?[0-5]\d)?)?'
+)
+
+# Critical trip_start + trip_end columns a completed trip must have
+REQUIRED_FIELDS = (
+    'trip_id',
+    'pickup_location_id',
+    'dropoff_location_id',
+    'vendor_id',
+    'pickup_datetime',
+    'dropoff_datetime',
+    'fare_amount',
+    'payment_type',
+    'trip_distance'
+)
+# String values treated as missing (None/NaN are caught by notna)
+EMPTY_SENTINELS = frozenset(('', 'null'))
+
+
+# Shared client tuning: the pool covers the parallel scan/upload workers, keep-alive
+# reuses TLS connections, and adaptive retries absorb throttling
+BOTO_CONFIG = Config(
+    max_pool_connections=max(MAX_SCAN_SEGMENTS, MAX_UPLOAD_WORKERS),
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=10
+)
+
+
+# AWS clients are created once on first use; cache_clear() resets them
+@lru_cache(maxsize=None)
+def get_dynamodb_client():
+    """Return the shared DynamoDB client."""
+    return boto3.client('dynamodb', config=BOTO_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Return the shared S3 client."""
+    return boto3.client('s3', config=BOTO_CONFIG.merge(Config(s3={'addressing_style': 'virtual'})))
+
+
+class S3MultipartLogHandler(logging.Handler):
+    """
+    Logging handler that streams records to S3 as one gzip object, uploading full
+    LOG_PART_BYTES parts in the background. close() uploads the last part and completes
+    the upload, or does nothing if no record was logged.
+    """
 
+    def __init__(self, bucket, key, part_bytes=LOG_PART_BYTES):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.upload_id = None
+        self.upload_error = None
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self.buffer = bytearray()
+        self.part_futures = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.upload_closed = False
+        self.has_records = False
+
+    def emit(self, record):
+        if self.upload_closed or self.upload_error:
+            return
+        self.has_records = True
+        try:
+            self.buffer.extend(self.compressor.compress((self.format(record) + '\n').encode('utf-8')))
+            if len(self.buffer) >= self.part_bytes:
+                self._flush_part()
+        except Exception:
+            self.handleError(record)
+
+    def _start_upload(self):
+        self.upload_id = get_s3_client().create_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            ContentType='text/plain',
+            ContentEncoding='gzip'
+        )['UploadId']
+
+    def _flush_part(self):
+        if self.upload_id is None:
+            try:
+                self._start_upload()
+            except Exception as e:
+                # Give up on S3 and drop what was buffered; the console handler still has it
+                self.upload_error = e
+                self.buffer.clear()
+                return
+        part_number = len(self.part_futures) + 1
+        body = bytes(self.buffer)
+        self.buffer.clear()
+        self.part_futures.append(self.executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        response = get_s3_client().upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=body
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.upload_closed:
+                return
+            self.upload_closed = True
+            if not self.has_records:
+                # Nothing was logged (e.g. the module was only imported): no object to upload
+                self.executor.shutdown()
+                super().close()
+                return
+            upload_error = self.upload_error
+            self.buffer.extend(self.compressor.flush())
+            last_part_number = len(self.part_futures) + 1
+            last_part = bytes(self.buffer)
+            self.buffer.clear()
+            part_futures = list(self.part_futures)
+        finally:
+            self.release()
+
+        # Wait for parts outside the handler lock: botocore may log from the upload thread.
+        # The last part is uploaded on this thread, since close() may run from
+        # logging.shutdown() after the executor stopped accepting work.
+        try:
+            if upload_error is not None:
+                raise RuntimeError(f"S3 log upload could not be started: {upload_error}")
+            if self.upload_id is None:
+                self._start_upload()
+            parts = [future.result() for future in part_futures]
+            parts.append(self._upload_part(last_part_number, last_part))
+            get_s3_client().complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            if self.upload_id is not None:
+                get_s3_client().abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            raise
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+
+if not logger.handlers:
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+    log_handler = S3MultipartLogHandler(
+        S3_BUCKET,
+        f"{S3_LOG_PREFIX}{datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f')}.log.gz"
+    )
+    log_handler.set_name(S3_LOG_HANDLER_NAME)
+    log_handler.setLevel(logging.INFO)
+    log_handler.setFormatter(formatter)
+    logger.addHandler(log_handler)
+log_handler = next(handler for handler in logger.handlers if handler.get_name() == S3_LOG_HANDLER_NAME)
 
 
 def read_state_file():
     """Read processed dates from state file or initialize it."""
     try:
-        response = s3.get_object(Bucket=S3_BUCKET, Key=S3_STATE_KEY)
-        state = json.loads(response['Body'].read().decode('utf-8'))
+        response = get_s3_client().get_object(Bucket=S3_BUCKET, Key=S3_STATE_KEY)
+        body = response['Body'].read()
+        # State files written before compression was introduced are plain JSON
+        if response.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        state = json.loads(body.decode('utf-8'))
         logger.info(f"Read state file: {state}")
         return state.get('processed_dates', [])
-    except s3.exceptions.NoSuchKey:
+    except get_s3_client().exceptions.NoSuchKey:
         logger.info("State file not found, initializing empty state.")
         return []
     except Exception as e:
@@ -50,11 +229,12 @@ def write_state_file(processed_dates):
     """Write updated processed dates to state file."""
     try:
         state = {'processed_dates': sorted(list(set(processed_dates)))}
-        s3.put_object(
+        get_s3_client().put_object(
             Bucket=S3_BUCKET,
             Key=S3_STATE_KEY,
-            Body=json.dumps(state, indent=2).encode('utf-8'),
-            ContentType='application/json'
+            Body=gzip.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'), GZIP_LEVEL),
+            ContentType='application/json',
+            ContentEncoding='gzip'
         )
         logger.info(f"Updated state file at s3://{S3_BUCKET}/{S3_STATE_KEY}")
     except Exception as e:
@@ -63,162 +243,160 @@ def write_state_file(processed_dates):
 
 
 def upload_logs_to_s3():
-    """Upload logs to S3."""
+    """Finish the streamed log upload to S3."""
     try:
-        log_content = log_buffer.getvalue()
-        timestamp = datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f')
-        s3_key = f"{S3_LOG_PREFIX}{timestamp}.log"
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=s3_key,
-            Body=log_content.encode('utf-8'),
-            ContentType='text/plain'
-        )
-        logger.info(f"Uploaded logs to s3://{S3_BUCKET}/{s3_key}")
+        log_handler.close()
+        logger.info(f"Uploaded logs to s3://{S3_BUCKET}/{log_handler.key}")
     except Exception as e:
         logger.error(f"Failed to upload logs to S3: {e}")
 
 
+def get_scan_segments():
+    """Derive the number of parallel scan segments from the table size."""
+    table_size = get_dynamodb_client().describe_table(TableName=TABLE_NAME)['Table'].get('TableSizeBytes', 0)
+    return min(MAX_SCAN_SEGMENTS, max(1, math.ceil(table_size / SCAN_SEGMENT_BYTES)))
+
+
+def scan_segment(segment, total_segments):
+    """
+    Scan a single segment of the DynamoDB table, reducing each page to per-date
+    fare aggregates as it arrives so raw items never accumulate in memory.
+    Returns (record_count, list of partial aggregates).
+    """
+    record_count = 0
+    partials = []
+    paginator = get_dynamodb_client().get_paginator('scan')
+    for page in paginator.paginate(TableName=TABLE_NAME, Segment=segment, TotalSegments=total_segments):
+        items = page.get('Items', [])
+        record_count += len(items)
+        if items:
+            partials.append(aggregate_daily_fares(filter_completed_trips(items)))
+    return record_count, partials
+
+
 def scan_dynamodb():
-    """Scan DynamoDB table to retrieve all trip records."""
+    """
+    Scan DynamoDB table in parallel segments and reduce completed trips to daily
+    fare aggregates. Returns (record_count, daily aggregates indexed by dropoff_date).
+    """
     try:
-        records = []
-        paginator = dynamodb.get_paginator('scan')
-        for page in paginator.paginate(TableName=TABLE_NAME):
-            records.extend(page.get('Items', []))
-        logger.info(f"Retrieved {len(records)} records from {TABLE_NAME}")
-        return records
+        total_segments = get_scan_segments()
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            results = list(executor.map(scan_segment, range(total_segments), [total_segments] * total_segments))
+        record_count = sum(count for count, _ in results)
+        daily_fares = merge_daily_fares(list(chain.from_iterable(partials for _, partials in results)))
+        logger.info(f"Retrieved {record_count} records from {TABLE_NAME} using {total_segments} scan segments")
+        logger.info(f"Found {int(daily_fares['count'].sum())} completed trips for {len(daily_fares)} days")
+        return record_count, daily_fares
     except Exception as e:
         logger.error(f"Failed to scan DynamoDB table: {e}")
         raise
 
 
-def parse_dynamodb_item(item):
-    """Parse DynamoDB item into a dictionary with native Python types."""
-    def convert_dynamodb_types(value):
-        if 'S' in value:
-            return value['S']
-        elif 'N' in value:
-            return Decimal(value['N'])
-        elif 'M' in value:
-            return {k: convert_dynamodb_types(v) for k, v in value['M'].items()}
-        elif 'L' in value:
-            return [convert_dynamodb_types(v) for v in value['L']]
-        return value
-    return {k: convert_dynamodb_types(v) for k, v in item.items()}
+def flatten_dynamodb_item(item):
+    """
+    Flatten the REQUIRED_FIELDS of a DynamoDB item to their raw string/number values;
+    other attribute types become None.
+    """
+    return {field: item[field].get('S', item[field].get('N')) for field in REQUIRED_FIELDS if field in item}
 
 
 def filter_completed_trips(records):
     """
-    Filter trips that have all critical columns present and non-null/non-empty.
-    Critical columns from trip_start and trip_end combined:
-      - trip_id
-      - pickup_location_id
-      - dropoff_location_id
-      - vendor_id
-      - pickup_datetime
-      - dropoff_datetime
-      - fare_amount
-      - payment_type
-      - trip_distance
+    Filter trips that have all critical columns (REQUIRED_FIELDS, from trip_start
+    and trip_end combined) present and non-null/non-empty.
+    Returns a DataFrame with trip_id, fare_amount (float) and dropoff_date (YYYY-MM-DD).
     """
-    completed_trips_by_date = defaultdict(list)
-
-    required_fields = [
-        'trip_id',
-        'pickup_location_id',
-        'dropoff_location_id',
-        'vendor_id',
-        'pickup_datetime',
-        'dropoff_datetime',
-        'fare_amount',
-        'payment_type',
-        'trip_distance'
-    ]
-
-    for record in records:
-        trip = parse_dynamodb_item(record)
-
-        # Check all required fields exist and are not null/empty
-        if all(field in trip and trip[field] not in (None, '', 'null') for field in required_fields):
-
-            # Validate fare_amount is positive number
-            try:
-                fare_amount = Decimal(str(trip['fare_amount']))
-                if fare_amount <= 0:
-                    logger.warning(f"Skipping trip_id {trip.get('trip_id')} due to non-positive fare_amount")
-                    continue
-            except Exception as e:
-                logger.warning(f"Skipping trip_id {trip.get('trip_id')} due to invalid fare_amount: {e}")
-                continue
-
-            # Parse dropoff date
-            try:
-                dropoff_datetime_str = trip['dropoff_datetime']
-                if dropoff_datetime_str.endswith('Z'):
-                    dropoff_datetime_str = dropoff_datetime_str[:-1]
-                dropoff_date = datetime.fromisoformat(dropoff_datetime_str).date().isoformat()
-            except Exception as e:
-                logger.warning(f"Invalid dropoff_datetime for trip_id {trip.get('trip_id')}: {e}")
-                continue
-
-            completed_trips_by_date[dropoff_date].append(trip)
-        else:
-            logger.warning(f"Incomplete or invalid trip data for trip_id {trip.get('trip_id')}")
-
-    logger.info(f"Found completed trips for {len(completed_trips_by_date)} days")
-    return completed_trips_by_date
-
-
-def calculate_kpis(trips_by_date):
-    """Calculate KPIs for each day."""
+    df = pd.DataFrame([flatten_dynamodb_item(record) for record in records], columns=REQUIRED_FIELDS, dtype=object)
+
+    # Check all required fields exist and are not null/empty
+    df = df.mask(df.isin(EMPTY_SENTINELS))
+    complete = df.notna().all(axis=1)
+    if not complete.all():
+        logger.warning(f"Skipping {int((~complete).sum())} trips with incomplete or invalid trip data")
+    df = df[complete]
+
+    # Validate fare_amount is positive number
+    df = df.assign(fare_amount=pd.to_numeric(df['fare_amount'], errors='coerce'))
+    valid_fare = df['fare_amount'] > 0
+    if not valid_fare.all():
+        logger.warning(f"Skipping {int((~valid_fare).sum())} trips with invalid or non-positive fare_amount")
+    df = df[valid_fare]
+
+    # Validate the whole dropoff_datetime, then parse only its date part, in the
+    # timestamp's own offset; an explicit strptime format behaves the same on every
+    # pandas version, and cache=True parses each distinct date string only once
+    well_formed = df['dropoff_datetime'].str.fullmatch(DROPOFF_DATETIME_PATTERN).fillna(False).astype(bool)
+    dropoff_date = pd.to_datetime(
+        df['dropoff_datetime'].where(well_formed).str.slice(0, 10), format='%Y-%m-%d', cache=True, errors='coerce'
+    )
+    df = df.assign(dropoff_date=dropoff_date.dt.strftime('%Y-%m-%d'))
+    valid_dropoff = df['dropoff_date'].notna()
+    if not valid_dropoff.all():
+        logger.warning(f"Skipping {int((~valid_dropoff).sum())} trips with invalid dropoff_datetime")
+    completed_trips = df.loc[valid_dropoff, ['trip_id', 'fare_amount', 'dropoff_date']]
+
+    logger.debug("Found completed trips for %d days", completed_trips['dropoff_date'].nunique())
+    return completed_trips
+
+
+def aggregate_daily_fares(trips):
+    """Reduce completed trips to per-date fare sum/count/max/min."""
+    return trips.groupby('dropoff_date')['fare_amount'].agg(['sum', 'count', 'max', 'min'])
+
+
+def merge_daily_fares(partials):
+    """Combine partial per-date aggregates: sums and counts add, max/min take the extremes."""
+    if not partials:
+        return pd.DataFrame(columns=['sum', 'count', 'max', 'min'])
+    return pd.concat(partials).groupby(level=0).agg({'sum': 'sum', 'count': 'sum', 'max': 'max', 'min': 'min'})
+
+
+def calculate_kpis(daily_fares):
+    """Calculate KPIs for each day from the daily fare aggregates."""
     kpis = {}
-    for date, trips in trips_by_date.items():
-        fares = []
-        for trip in trips:
-            try:
-                fares.append(Decimal(str(trip['fare_amount'])))
-            except Exception as e:
-                logger.warning(f"Skipping trip with invalid fare_amount on {date}: {e}")
-
-        if not fares:
-            logger.info(f"No valid fares for {date}, skipping KPIs")
-            continue
-
-        total_fare = sum(fares)
-        count_trips = len(fares)
-        average_fare = total_fare / count_trips if count_trips > 0 else Decimal('0')
-        max_fare = max(fares)
-        min_fare = min(fares)
-
+    # average is derived from sum/count instead of a separate mean aggregation
+    for date, row in daily_fares.iterrows():
         kpis[date] = {
             'date': date,
-            'total_fare': float(total_fare),
-            'count_trips': count_trips,
-            'average_fare': float(average_fare),
-            'max_fare': float(max_fare),
-            'min_fare': float(min_fare)
+            'total_fare': float(row['sum']),
+            'count_trips': int(row['count']),
+            'average_fare': float(row['sum'] / row['count']),
+            'max_fare': float(row['max']),
+            'min_fare': float(row['min'])
         }
-        logger.info(f"Calculated KPIs for {date}: {kpis[date]}")
+        logger.debug("Calculated KPIs for %s: %s", date, kpis[date])
+    logger.info(f"Calculated KPIs for {len(kpis)} days")
     return kpis
 
 
+def write_kpi_to_s3(date, kpi):
+    """Write a single day's KPIs to S3 as a JSON file."""
+    try:
+        year, month, day = date.split('-')
+        s3_key = f"{S3_KPI_PREFIX}{year}/{month}/{day}/{date}.json.gz"
+        get_s3_client().put_object(
+            Bucket=S3_BUCKET,
+            Key=s3_key,
+            Body=gzip.compress(json.dumps(kpi, separators=(',', ':')).encode('utf-8'), GZIP_LEVEL),
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+        logger.debug("Wrote KPIs to s3://%s/%s", S3_BUCKET, s3_key)
+    except Exception as e:
+        logger.error(f"Failed to write KPIs for {date} to S3: {e}")
+        raise
+
+
 def write_kpis_to_s3(kpis):
-    """Write KPIs to S3 as JSON files."""
-    for date, kpi in kpis.items():
-        try:
-            year, month, day = date.split('-')
-            s3_key = f"{S3_KPI_PREFIX}{year}/{month}/{day}/{date}.json"
-            s3.put_object(
-                Bucket=S3_BUCKET,
-                Key=s3_key,
-                Body=json.dumps(kpi, indent=2).encode('utf-8'),
-                ContentType='application/json'
-            )
-            logger.info(f"Wrote KPIs to s3://{S3_BUCKET}/{s3_key}")
-        except Exception as e:
-            logger.error(f"Failed to write KPIs for {date} to S3: {e}")
-            raise
+    """Write KPIs to S3 as JSON files, one concurrent upload per date."""
+    if not kpis:
+        return
+    with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, len(kpis))) as executor:
+        futures = [executor.submit(write_kpi_to_s3, date, kpi) for date, kpi in kpis.items()]
+        for future in futures:
+            future.result()
+    logger.info(f"Wrote KPIs for {len(kpis)} days to s3://{S3_BUCKET}/{S3_KPI_PREFIX}")
 
 
 def main():
@@ -231,32 +409,29 @@ def main():
         # Read processed dates from state file
         processed_dates = read_state_file()
 
-        # Scan all records from DynamoDB
-        records = scan_dynamodb()
-        if not records:
+        # Scan all records from DynamoDB, reduced to fare aggregates per dropoff date
+        record_count, daily_fares = scan_dynamodb()
+        if not record_count:
             logger.info("No records found in DynamoDB, exiting.")
             upload_logs_to_s3()
             return
 
-        # Filter completed trips grouped by dropoff date
-        trips_by_date = filter_completed_trips(records)
-
         # Find unprocessed dates
-        unprocessed_dates = [date for date in trips_by_date.keys() if date not in processed_dates]
+        unprocessed_dates = [date for date in daily_fares.index if date not in processed_dates]
 
         # Dates to process: yesterday + any unprocessed dates
         dates_to_process = sorted(set(unprocessed_dates + [yesterday]))
         logger.info(f"Dates to process: {dates_to_process}")
 
-        # Filter trips for dates to process
-        trips_to_process = {date: trips_by_date[date] for date in dates_to_process if date in trips_by_date}
-        if not trips_to_process:
+        # Filter aggregates for dates to process
+        daily_fares_to_process = daily_fares[daily_fares.index.isin(dates_to_process)]
+        if daily_fares_to_process.empty:
             logger.info("No trips to process for specified dates, exiting.")
             upload_logs_to_s3()
             return
 
         # Calculate KPIs
-        kpis = calculate_kpis(trips_to_process)
+        kpis = calculate_kpis(daily_fares_to_process)
         if not kpis:
             logger.info("No KPIs calculated, exiting.")
             upload_logs_to_s3()
@@ -265,9 +440,12 @@ def main():
         # Write KPIs to S3
         write_kpis_to_s3(kpis)
 
-        # Update state file with processed dates
-        processed_dates.extend(dates_to_process)
-        write_state_file(processed_dates)
+        # Update state file with processed dates, skipping the PUT if nothing changed
+        if set(dates_to_process) - set(processed_dates):
+            processed_dates.extend(dates_to_process)
+            write_state_file(processed_dates)
+        else:
+            logger.info("State file unchanged, skipping upload.")
 
         logger.info("Glue job completed successfully.")
         upload_logs_to_s3()
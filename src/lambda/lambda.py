@@ -4,22 +4,51 @@ import logging
 import uuid
 import base64
 import os
+import time
+from collections import Counter
 from datetime import datetime
-from decimal import Decimal
+from decimal import Context
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# Per-record messages are logged at DEBUG; set LOG_LEVEL=DEBUG to see them
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
 # Explicitly set region for boto3 clients/resources
 REGION = os.environ.get('AWS_REGION', 'eu-north-1')
 
-dynamodb = boto3.client('dynamodb', region_name=REGION)
-dynamodb_resource = boto3.resource('dynamodb', region_name=REGION)
+# Module-level clients survive warm invocations; keep-alive reuses their connections
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=10
+)
+
+dynamodb = boto3.client('dynamodb', region_name=REGION, config=BOTO_CONFIG)
+dynamodb_resource = boto3.resource('dynamodb', region_name=REGION, config=BOTO_CONFIG)
 
 TABLE_NAME = 'TripData'
 ERROR_TABLE_NAME = 'TripDataErrors'
 
+# DynamoDB batch API limits and retry policy for unprocessed entries
+BATCH_GET_MAX_KEYS = 100
+BATCH_WRITE_MAX_ITEMS = 25
+MAX_BATCH_RETRIES = 5
+BATCH_RETRY_BASE_DELAY = 0.05
+
+# Required fields per event type; trip_id is checked first on its own
+_TRIP_START_FIELDS = ('pickup_location_id', 'dropoff_location_id', 'vendor_id', 'pickup_datetime')
+_TRIP_END_FIELDS = ('dropoff_datetime', 'fare_amount', 'payment_type', 'trip_distance')
+_BLANK_STRINGS = ('', 'null')
+
+# DynamoDB numbers hold at most 38 significant digits; JSON floats are rounded to fit while parsing
+_DECIMAL_CONTEXT = Context(prec=38)
+
+# The table-exists check runs once per container and is skipped on warm invocations
+_TABLES_READY = False
+
 
 def create_table_if_not_exists(table_name, key_name):
     try:
@@ -49,149 +78,247 @@ def create_table_if_not_exists(table_name, key_name):
             logger.error(f"Error checking table existence: {e}", exc_info=True)
             raise
 
-def convert_floats_to_decimal(obj):
-    if isinstance(obj, float):
-        return Decimal(str(obj))
-    elif isinstance(obj, dict):
-        return {k: convert_floats_to_decimal(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_floats_to_decimal(item) for item in obj]
-    else:
-        return obj
-
 def is_blank(val):
     # Returns True if val is None, empty string, only whitespace, or 'null'
     return val is None or (isinstance(val, str) and val.strip() == '') or val == 'null'
 
 
-def upsert_error_record(error_table, trip_id, reason, original_data):
+def add_error_record(errors, trip_id, reason, original_data):
+    """Queue an error for trip_id; errors for the same trip are merged before the batch write."""
     timestamp = datetime.utcnow().isoformat() + 'Z'
+    error = errors.setdefault(trip_id, {'reasons': [], 'timestamps': []})
+    error['reasons'].append(reason)
+    error['timestamps'].append(timestamp)
+    error['original_data'] = original_data
+
+
+def call_with_unprocessed_retry(operation, request_items, unprocessed_key):
+    """Call a DynamoDB batch operation, retrying unprocessed entries with exponential backoff."""
+    responses = []
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        response = operation(RequestItems=request_items)
+        responses.append(response)
+        request_items = response.get(unprocessed_key) or {}
+        if not request_items:
+            return responses
+        delay = BATCH_RETRY_BASE_DELAY * (2 ** attempt)
+        logger.warning(f"{unprocessed_key} returned for {list(request_items)}, retrying in {delay:.2f}s")
+        time.sleep(delay)
+    raise RuntimeError(f"{unprocessed_key} still pending after {MAX_BATCH_RETRIES} retries")
+
+
+def batch_get_items(table_name, trip_ids, projection=None):
+    """Fetch existing items keyed by trip_id with strongly consistent BatchGetItem."""
+    trip_ids = list(trip_ids)
+    items = {}
+    for i in range(0, len(trip_ids), BATCH_GET_MAX_KEYS):
+        # Strongly consistent: the merge must see what the previous invocation just wrote
+        keys_and_attributes = {
+            'Keys': [{'trip_id': trip_id} for trip_id in trip_ids[i:i + BATCH_GET_MAX_KEYS]],
+            'ConsistentRead': True
+        }
+        if projection:
+            keys_and_attributes['ProjectionExpression'] = projection
+        request_items = {table_name: keys_and_attributes}
+        for response in call_with_unprocessed_retry(dynamodb_resource.batch_get_item, request_items, 'UnprocessedKeys'):
+            for item in response.get('Responses', {}).get(table_name, []):
+                items[item['trip_id']] = item
+    return items
+
+
+def get_items_with_fallback(table_name, trip_ids, projection=None):
+    """
+    Fetch existing items with BatchGetItem; if the batch read fails, read each key with
+    GetItem instead. Returns (items by trip_id, trip_ids that could not be read).
+    """
     try:
-        # Convert floats in original_data to Decimal before writing to DynamoDB
-        original_data = convert_floats_to_decimal(original_data)
-
-        response = error_table.update_item(
-            Key={'trip_id': trip_id},
-            UpdateExpression="""
-                SET error_reasons = list_append(if_not_exists(error_reasons, :empty_list), :new_reason),
-                    error_timestamps = list_append(if_not_exists(error_timestamps, :empty_list), :new_timestamp),
-                    original_data = :original_data
-            """,
-            ExpressionAttributeValues={
-                ':new_reason': [reason],
-                ':new_timestamp': [timestamp],
-                ':empty_list': [],
-                ':original_data': original_data
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        logger.info(f"Upserted error record for trip_id {trip_id} with reason: {reason}")
+        return batch_get_items(table_name, trip_ids, projection), []
     except Exception as e:
-        logger.error(f"Failed to upsert error record for trip_id {trip_id}: {e}", exc_info=True)
-        raise
+        logger.warning(f"Batch read from {table_name} failed, falling back to per-item reads: {e}")
+    table = dynamodb_resource.Table(table_name)
+    items = {}
+    failed = []
+    for trip_id in trip_ids:
+        try:
+            kwargs = {'Key': {'trip_id': trip_id}, 'ConsistentRead': True}
+            if projection:
+                kwargs['ProjectionExpression'] = projection
+            item = table.get_item(**kwargs).get('Item')
+            if item:
+                items[trip_id] = item
+        except Exception as e:
+            logger.error(f"Failed to read {trip_id} from {table_name}: {e}", exc_info=True)
+            failed.append(trip_id)
+    return items, failed
+
+
+def batch_put_items(table_name, items):
+    """
+    Write full items with BatchWriteItem, 25 items per request. If a request fails, its
+    items are written one by one with PutItem so a single bad item cannot fail the rest.
+    Returns the trip_ids that could not be written.
+    """
+    table = dynamodb_resource.Table(table_name)
+    failed = []
+    for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        chunk = items[i:i + BATCH_WRITE_MAX_ITEMS]
+        request_items = {table_name: [{'PutRequest': {'Item': item}} for item in chunk]}
+        try:
+            call_with_unprocessed_retry(dynamodb_resource.batch_write_item, request_items, 'UnprocessedItems')
+        except Exception as e:
+            logger.warning(f"Batch write to {table_name} failed, falling back to per-item writes: {e}")
+            for item in chunk:
+                try:
+                    table.put_item(Item=item)
+                except Exception as item_error:
+                    logger.error(f"Failed to write {item['trip_id']} to {table_name}: {item_error}", exc_info=True)
+                    failed.append(item['trip_id'])
+    return failed
+
+
+def write_trip_records(trips):
+    """
+    Write validated trips keyed by trip_id with batched PutItem and return the set
+    of trip_ids that could not be written.
+    Trips already in the table are merged with the stored item first, so fields
+    from the other event type (trip_start vs trip_end) are preserved; a trip whose
+    stored item cannot be read is not written rather than overwritten. The
+    simulator partitions by trip_id, so both events of a trip arrive on the same
+    shard and are never merged concurrently; reads are strongly consistent, so the
+    merge always sees the item written by the previous invocation.
+    """
+    if not trips:
+        return set()
+    existing, failed = get_items_with_fallback(TABLE_NAME, list(trips))
+    items = [{**existing.get(trip_id, {}), **data} for trip_id, data in trips.items() if trip_id not in failed]
+    failed += batch_put_items(TABLE_NAME, items)
+    logger.info(f"Wrote {len(trips) - len(failed)} trips in batches ({len(existing)} merged with existing items, "
+                f"{len(failed)} failed)")
+    return set(failed)
+
+
+def write_error_records(errors):
+    """
+    Merge queued errors with the existing error lists, read strongly consistently so
+    lists written by the previous invocation are kept, and batch-put them to the error table.
+    Returns the set of trip_ids whose error records could not be written.
+    """
+    if not errors:
+        return set()
+    existing, failed = get_items_with_fallback(ERROR_TABLE_NAME, list(errors), 'trip_id, error_reasons, error_timestamps')
+    items = []
+    for trip_id, error in errors.items():
+        if trip_id in failed:
+            continue
+        previous = existing.get(trip_id, {})
+        items.append({
+            'trip_id': trip_id,
+            'error_reasons': previous.get('error_reasons', []) + error['reasons'],
+            'error_timestamps': previous.get('error_timestamps', []) + error['timestamps'],
+            'original_data': error['original_data']
+        })
+    failed += batch_put_items(ERROR_TABLE_NAME, items)
+    logger.info(f"Upserted {len(errors) - len(failed)} error records ({len(failed)} failed)")
+    return set(failed)
 
 def validate_record(data):
     trip_id = data.get('trip_id')
-    if is_blank(trip_id) or not isinstance(trip_id, str):
+    if type(trip_id) is not str or trip_id in _BLANK_STRINGS or not trip_id.strip():
         return False, "Missing or invalid trip_id"
 
     # Strict validation for trip_start
     if 'pickup_location_id' in data:
-        required_fields = [
-            'trip_id',
-            'pickup_location_id',
-            'dropoff_location_id',
-            'vendor_id',
-            'pickup_datetime'
-        ]
-        for field in required_fields:
-            if field not in data or is_blank(data[field]):
+        for field in _TRIP_START_FIELDS:
+            value = data.get(field)
+            # Inlined is_blank(): None, empty/whitespace-only string, or 'null'
+            if value is None or (type(value) is str and (value in _BLANK_STRINGS or not value.strip())):
                 return False, f"Missing, null, or blank required field '{field}' in trip_start"
         return True, "trip_start"
 
     # Strict validation for trip_end
     elif 'dropoff_datetime' in data:
-        required_fields = [
-            'trip_id',
-            'dropoff_datetime',
-            'fare_amount',
-            'payment_type',
-            'trip_distance'
-        ]
-        for field in required_fields:
-            if field not in data or is_blank(data[field]):
+        for field in _TRIP_END_FIELDS:
+            value = data.get(field)
+            if value is None or (type(value) is str and (value in _BLANK_STRINGS or not value.strip())):
                 return False, f"Missing, null, or blank required field '{field}' in trip_end"
         return True, "trip_end"
 
     else:
         return False, "Unknown record type - missing key fields"
-    
+
 
 
 def lambda_handler(event, context):
+    global _TABLES_READY
     try:
         if not event.get('Records', []):
             logger.info("Received empty batch from Kinesis, possible outage.")
             return {'statusCode': 200, 'body': json.dumps('No records to process')}
 
-        create_table_if_not_exists(TABLE_NAME, 'trip_id')
-        create_table_if_not_exists(ERROR_TABLE_NAME, 'trip_id')
+        if not _TABLES_READY:
+            create_table_if_not_exists(TABLE_NAME, 'trip_id')
+            create_table_if_not_exists(ERROR_TABLE_NAME, 'trip_id')
+            _TABLES_READY = True
 
-        table = dynamodb_resource.Table(TABLE_NAME)
-        error_table = dynamodb_resource.Table(ERROR_TABLE_NAME)
+        # Records are coalesced per trip_id and written in batches after the loop;
+        # trip_events counts the events merged into each trip
+        trips = {}
+        trip_events = Counter()
+        errors = {}
 
-        processed_records = 0
-        error_records = 0
         failed_records = 0
 
         for record in event['Records']:
             try:
-                kinesis_data = record['kinesis']['data']
-                decoded_data = base64.b64decode(kinesis_data).decode('utf-8')
-                data = json.loads(decoded_data)
-
-                is_valid, reason = validate_record(data)
-                logger.info(f"Validation result for trip_id {data.get('trip_id')}: {is_valid}, reason: {reason}")
-
-                if not is_valid:
-                    trip_id = data.get('trip_id')
-                    if is_blank(trip_id) or not isinstance(trip_id, str):
-                        trip_id = str(uuid.uuid4())
-                    upsert_error_record(error_table, trip_id, reason, data)
-                    error_records += 1
-                    logger.warning(f"Invalid record upserted in error table: reason={reason}, trip_id={trip_id}")
-                    continue
-
-                data = convert_floats_to_decimal(data)
-                trip_id = data['trip_id']
-
-                update_expression_parts = []
-                expression_attribute_values = {}
-
-                for k, v in data.items():
-                    if k == 'trip_id':
-                        continue  # skip primary key attribute
-                    placeholder = f":{k}"
-                    update_expression_parts.append(f"{k} = {placeholder}")
-                    expression_attribute_values[placeholder] = v
-
-                update_expression = "SET " + ", ".join(update_expression_parts)
-
-                table.update_item(
-                    Key={'trip_id': trip_id},
-                    UpdateExpression=update_expression,
-                    ExpressionAttributeValues=expression_attribute_values
-                )
-
-                processed_records += 1
-                logger.info(f"Upserted record for trip_id: {trip_id}, event_type: {reason}")
-
-            except (json.JSONDecodeError, base64.binascii.Error) as e:
+                decoded_data = base64.b64decode(record['kinesis']['data'])
+            except base64.binascii.Error as e:
                 logger.error(f"Failed to decode record data: {e}", exc_info=True)
                 failed_records += 1
+                continue
             except Exception as e:
                 logger.error(f"Error processing record: {e}", exc_info=True)
                 failed_records += 1
+                continue
+
+            # Producers aggregate several newline-delimited JSON events into one Kinesis record
+            for line in decoded_data.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    # json.loads takes the bytes directly; floats are parsed straight to
+                    # Decimal rounded to DynamoDB's precision so records are ready to store,
+                    # and NaN/Infinity (which DynamoDB cannot store) are treated as missing values
+                    data = json.loads(line, parse_float=_DECIMAL_CONTEXT.create_decimal, parse_constant=lambda _: None)
+
+                    is_valid, reason = validate_record(data)
+
+                    if not is_valid:
+                        trip_id = data.get('trip_id')
+                        if is_blank(trip_id) or not isinstance(trip_id, str):
+                            trip_id = str(uuid.uuid4())
+                        add_error_record(errors, trip_id, reason, data)
+                        logger.debug("Invalid record queued for error table: reason=%s, trip_id=%s", reason, trip_id)
+                        continue
+
+                    trip_id = data['trip_id']
+                    trips.setdefault(trip_id, {}).update(data)
+                    trip_events[trip_id] += 1
+                    logger.debug("Queued record for trip_id: %s, event_type: %s", trip_id, reason)
+
+                except json.JSONDecodeError as e:
+                    logger.error(f"Failed to decode record data: {e}", exc_info=True)
+                    failed_records += 1
+                except Exception as e:
+                    logger.error(f"Error processing record: {e}", exc_info=True)
+                    failed_records += 1
+
+        # Events only count as processed once their trip or error record is written
+        failed_trips = write_trip_records(trips)
+        failed_errors = write_error_records(errors)
+        processed_records = sum(count for trip_id, count in trip_events.items() if trip_id not in failed_trips)
+        error_records = sum(len(error['reasons']) for trip_id, error in errors.items() if trip_id not in failed_errors)
+        failed_records += sum(trip_events[trip_id] for trip_id in failed_trips)
+        failed_records += sum(len(errors[trip_id]['reasons']) for trip_id in failed_errors)
 
         logger.info(f"Processing complete. Processed: {processed_records}, Errors: {error_records}, Failed: {failed_records}")
 
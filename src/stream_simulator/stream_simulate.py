@@ -1,14 +1,22 @@
 import os
 import sys
-import json
+import queue
+import atexit
 import random
+import asyncio
 import time
+import zlib
 import logging
-from logging.handlers import RotatingFileHandler
-from datetime import datetime, timedelta
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import pandas as pd
+import orjson
+import polars as pl
 import boto3
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
 
@@ -26,34 +34,103 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TRIP_START_CSV = os.path.join(BASE_DIR, "data", "trip_start.csv")
 TRIP_END_CSV = os.path.join(BASE_DIR, "data", "trip_end.csv")
 
+# Full, header-ordered schemas of the trip CSVs so Polars skips type inference;
+# trip_id and the datetimes stay the original strings
+TRIP_START_SCHEMA = {
+    'trip_id': pl.Utf8,
+    'pickup_location_id': pl.Int64,
+    'dropoff_location_id': pl.Int64,
+    'vendor_id': pl.Int64,
+    'pickup_datetime': pl.Utf8,
+    'estimated_dropoff_datetime': pl.Utf8,
+    'estimated_fare_amount': pl.Float64
+}
+TRIP_END_SCHEMA = {
+    'dropoff_datetime': pl.Utf8,
+    'rate_code': pl.Float64,
+    'passenger_count': pl.Float64,
+    'trip_distance': pl.Float64,
+    'fare_amount': pl.Float64,
+    'tip_amount': pl.Float64,
+    'payment_type': pl.Float64,
+    'trip_type': pl.Float64,
+    'trip_id': pl.Utf8
+}
+
+# Kinesis PutRecords limits: 500 records and 5 MB (data + partition keys) per call
+MAX_RECORDS_PER_PUT = 500
+MAX_BYTES_PER_PUT = 5 * 1024 * 1024
+MAX_PUT_RETRIES = 5
+PUT_RETRY_BASE_DELAY = 0.1
+PUT_RETRY_JITTER = 0.05
+THROTTLING_ERROR_CODE = 'ProvisionedThroughputExceededException'
+
+# Events are packed newline-delimited into aggregated Kinesis records of up to one 25 KB
+# PUT payload unit, per partition-key bucket; a trip's events always hash to the same bucket
+MAX_AGGREGATE_BYTES = 25 * 1024
+PARTITION_KEY_BUCKETS = 16
+PK_POOL = [str(bucket) for bucket in range(PARTITION_KEY_BUCKETS)]
+
+# Concurrent PutRecords senders, and in-flight batches allowed before the driver blocks
+SEND_WORKERS = 8
+MAX_INFLIGHT_BATCHES = 16
+
+# One client is shared by all senders: the pool covers every worker, keep-alive reuses
+# TLS connections, and adaptive retries absorb throttling of whole PutRecords calls
+BOTO_CONFIG = Config(
+    max_pool_connections=SEND_WORKERS,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=10
+)
+
+# Seconds between aggregated send-stats log lines; per-batch detail is logged at DEBUG
+STATS_LOG_INTERVAL = 10
+
+# Closes the event_timestamp value spliced onto each pre-serialized record
+EVENT_TIMESTAMP_SUFFIX = b'Z"}'
+
 def setup_logging():
     if not os.path.exists(LOG_DIR):
         os.makedirs(LOG_DIR)
     logger = logging.getLogger("TripStreamLogger")
-    logger.setLevel(logging.INFO)
+    # Re-importing the module must not attach a second set of handlers
+    if logger.handlers:
+        return logger
+    # DEBUG enables the per-batch send logs; handlers pass whatever the logger lets through
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
     log_path = os.path.join(LOG_DIR, LOG_FILE)
     handler = RotatingFileHandler(log_path, maxBytes=5*1024*1024, backupCount=3)
-    handler.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    # Callers only enqueue records; file and console I/O happen on the listener's thread.
+    # Stopping the listener at exit flushes whatever is still queued.
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, handler, console_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
     return logger
 
 logger = setup_logging()
 
-def load_data(csv_path):
+# Send counters keyed by (source_name, metric), updated by every sender thread
+_send_stats = Counter()
+_send_stats_lock = threading.Lock()
+
+def load_data(csv_path, schema):
+    """Load a trip CSV with a known schema as a list of row dicts."""
     try:
-        df = pd.read_csv(csv_path)
-        logger.info(f"Loaded {len(df)} records from {csv_path}")
-        return df
+        records = pl.read_csv(csv_path, schema=schema).to_dicts()
+        logger.info(f"Loaded {len(records)} records from {csv_path}")
+        return records
     except FileNotFoundError as e:
         logger.error(f"CSV file not found: {csv_path}")
         raise e
-    except pd.errors.ParserError as e:
+    except pl.exceptions.ComputeError as e:
         logger.error(f"Error parsing CSV file: {e}")
         raise e
 
@@ -63,108 +140,252 @@ def init_kinesis_client():
             'kinesis',
             region_name=AWS_REGION,
             aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            config=BOTO_CONFIG
         )
-        return client
     except Exception as e:
         logger.error(f"Failed to initialize Kinesis client: {e}")
         raise e
+    # Resolve credentials and open a connection to the endpoint before streaming starts,
+    # so the first put_records does not pay for it
+    try:
+        client.describe_stream_summary(StreamName=KINESIS_STREAM_NAME)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f"Kinesis client warm-up failed, continuing: {e}")
+    return client
+
+
+def partition_key_for(trip_id):
+    """Map a trip_id to its pooled partition key; both events of a trip map to the same key."""
+    return PK_POOL[zlib.crc32(str(trip_id).encode('utf-8')) % PARTITION_KEY_BUCKETS]
+
+
+def next_batch_decision(now, outage_end_time, remaining, base_rate, spike_chance, max_spike, outage_chance, outage_duration_range):
+    """
+    Decide the next emission from the outage/spike state, without any I/O. Times are
+    time.monotonic() seconds.
+    Returns (num_to_send, outage_end_time, spiked); num_to_send is 0 during an outage
+    and outage_end_time is None outside one.
+    """
+    if outage_end_time is not None:
+        if now < outage_end_time:
+            return 0, outage_end_time, False
+    elif random.random() < outage_chance:
+        # Randomly start an outage
+        return 0, now + random.uniform(*outage_duration_range), False
 
+    # Normally send base_rate records, capped at what is left of the data
+    if random.random() < spike_chance:
+        return min(random.randint(base_rate, max_spike), remaining), None, True
+    return min(base_rate, remaining), None, False
 
-def data_stream_generator(df, name, base_rate=1, spike_chance=0.05, max_spike=100, outage_chance=0.1, outage_duration_range=(5, 15)):
+
+async def data_stream_generator(records, name, base_rate=1, spike_chance=0.05, max_spike=100, outage_chance=0.1, outage_duration_range=(5, 15)):
     """
-    Generator that sends each unique record exactly once in random order,
-    with random spikes and outages.
+    Async generator that sends each unique record exactly once in random order,
+    with random spikes and outages. Yields batches of (partition_key, json_prefix, timestamp)
+    triples; an event's payload is json_prefix + timestamp.
     """
-    indices = list(df.index)
-    random.shuffle(indices)
-    total_records = len(indices)
+    random.shuffle(records)
+    # Serialize every row and resolve its partition key once up front, leaving
+    # event_timestamp open for splicing at emit time (orjson encodes NaN as null)
+    prefixes = [
+        (partition_key_for(record['trip_id']), orjson.dumps(record)[:-1] + b',"event_timestamp":"')
+        for record in records
+    ]
+    total_records = len(records)
     logger.info(f"{name} stream generator shuffled {total_records} unique records.")
 
-    outage = False
     outage_end_time = None
     sent_records = 0
 
     while sent_records < total_records:
-        if outage:
-            if datetime.utcnow() >= outage_end_time:
-                outage = False
-                logger.info(f"{name} stream outage ended, resuming.")
-            else:
-                # During outage, yield empty batch and sleep 1 sec
-                yield []
-                time.sleep(1)
-                continue
-        else:
-            # Randomly start an outage
-            if random.random() < outage_chance:
-                outage = True
-                outage_length = random.uniform(*outage_duration_range)
-                outage_end_time = datetime.utcnow() + timedelta(seconds=outage_length)
-                logger.warning(f"{name} stream outage started for {outage_length:.1f} seconds")
-                yield []
-                time.sleep(1)
-                continue
-
-        # Determine number of records to send this iteration
-        if random.random() < spike_chance:
-            num_to_send = random.randint(base_rate, max_spike)
-            logger.info(f"{name} stream spike: sending {num_to_send} records")
-        else:
-            # Normally send base_rate records (usually 1)
-            num_to_send = base_rate
+        # Outages are timed on the monotonic clock; wall-clock time is only for event_timestamp
+        now = time.monotonic()
+        num_to_send, next_outage_end_time, spiked = next_batch_decision(
+            now, outage_end_time, total_records - sent_records,
+            base_rate, spike_chance, max_spike, outage_chance, outage_duration_range
+        )
+        if outage_end_time is not None and next_outage_end_time is None:
+            logger.info(f"{name} stream outage ended, resuming.")
+        elif outage_end_time is None and next_outage_end_time is not None:
+            outage_length = next_outage_end_time - now
+            logger.warning(f"{name} stream outage started for {outage_length:.1f} seconds")
+        outage_end_time = next_outage_end_time
 
-        # Adjust if near end of data
-        remaining = total_records - sent_records
-        num_to_send = min(num_to_send, remaining)
+        if num_to_send == 0:
+            # During outage, yield empty batch and sleep 1 sec
+            yield []
+            await asyncio.sleep(1)
+            continue
 
-        batch = []
-        for _ in range(num_to_send):
-            idx = indices[sent_records]
-            record = df.loc[idx].to_dict()
-            record['event_timestamp'] = datetime.utcnow().isoformat() + 'Z'
-            batch.append(json.dumps(record))
-            sent_records += 1
+        if spiked:
+            logger.debug("%s stream spike: sending %d records", name, num_to_send)
+
+        # Every record in a batch (including a spike) is emitted at the same instant
+        timestamp = datetime.utcnow().isoformat().encode() + EVENT_TIMESTAMP_SUFFIX
+        # The shared timestamp is only referenced here; it is joined onto the prefixes in
+        # one pass when the aggregated Kinesis record is built
+        batch = [
+            (partition_key, prefix, timestamp)
+            for partition_key, prefix in prefixes[sent_records:sent_records + num_to_send]
+        ]
+        sent_records += num_to_send
 
         yield batch
 
         # Sleep roughly 1 second with jitter
-        time.sleep(max(1 + random.uniform(-0.3, 0.3), 0.1))
+        await asyncio.sleep(max(1 + random.uniform(-0.3, 0.3), 0.1))
 
     logger.info(f"{name} stream generator exhausted all unique records.")
 
 
+def aggregate_kinesis_records(batch):
+    """Pack (partition_key, json_prefix, timestamp) events into newline-delimited Kinesis records per partition key."""
+    buckets = {}
+    for partition_key, prefix, timestamp in batch:
+        buckets.setdefault(partition_key, []).append((prefix, timestamp))
+    records = []
+    for partition_key, events in buckets.items():
+        # Pieces of the aggregate are joined once, without building each event's bytes first
+        pieces = []
+        aggregate_bytes = 0
+        for prefix, timestamp in events:
+            event_bytes = len(prefix) + len(timestamp) + 1
+            if pieces and aggregate_bytes + event_bytes > MAX_AGGREGATE_BYTES:
+                pieces.pop()
+                records.append({'Data': b''.join(pieces), 'PartitionKey': partition_key})
+                pieces = []
+                aggregate_bytes = 0
+            pieces += (prefix, timestamp, b'\n')
+            aggregate_bytes += event_bytes
+        pieces.pop()
+        records.append({'Data': b''.join(pieces), 'PartitionKey': partition_key})
+    return records
+
+
+def chunk_kinesis_records(records):
+    """Split records into chunks that fit the PutRecords count and size limits."""
+    chunk = []
+    chunk_bytes = 0
+    for record in records:
+        # Pooled partition keys are ASCII, so their str length is their byte length
+        record_bytes = len(record['Data']) + len(record['PartitionKey'])
+        if chunk and (len(chunk) >= MAX_RECORDS_PER_PUT or chunk_bytes + record_bytes > MAX_BYTES_PER_PUT):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(record)
+        chunk_bytes += record_bytes
+    if chunk:
+        yield chunk
+
+
+def put_records_with_retry(kinesis_client, stream_name, chunk, source_name):
+    """
+    Put a chunk of records, retrying only the failed entries. Backs off with jittered
+    exponential delay only when throttled or when the call itself failed; other entry
+    failures are retried straight away. Returns the records that still failed after the
+    last retry.
+    """
+    for attempt in range(MAX_PUT_RETRIES + 1):
+        try:
+            response = kinesis_client.put_records(StreamName=stream_name, Records=chunk)
+        except (BotoCoreError, ClientError) as e:
+            # The client has already retried the call; keep the whole chunk for another attempt
+            logger.warning(f"PutRecords call failed for {source_name}: {e}")
+            back_off = True
+        else:
+            if response.get('FailedRecordCount', 0) == 0:
+                return []
+            results = response['Records']
+            back_off = any(result.get('ErrorCode') == THROTTLING_ERROR_CODE for result in results)
+            chunk = [record for record, result in zip(chunk, results) if 'ErrorCode' in result]
+        if attempt < MAX_PUT_RETRIES:
+            if back_off:
+                delay = PUT_RETRY_BASE_DELAY * (2 ** attempt) + random.random() * PUT_RETRY_JITTER
+                logger.warning(f"{len(chunk)} records not put to Kinesis for {source_name}, retrying in {delay:.2f}s")
+                time.sleep(delay)
+            else:
+                logger.warning(f"{len(chunk)} records failed to put to Kinesis for {source_name}, retrying")
+    logger.error(f"{len(chunk)} records failed to put to Kinesis for {source_name} after {MAX_PUT_RETRIES} retries")
+    return chunk
+
+
 def send_batch_to_kinesis(batch, kinesis_client, stream_name, source_name):
     if not batch:
         logger.info(f"No records to send for {source_name} (possible outage).")
         return
-    records = []
-    for record_str in batch:
-        partition_key = str(random.randint(1, 1000000))
-        records.append({'Data': record_str.encode('utf-8'), 'PartitionKey': partition_key})
-    max_records_per_call = 500
-    for i in range(0, len(records), max_records_per_call):
-        chunk = records[i:i+max_records_per_call]
-        try:
-            response = kinesis_client.put_records(
-                StreamName=stream_name,
-                Records=chunk
-            )
-            failed_count = response.get('FailedRecordCount', 0)
-            if failed_count > 0:
-                logger.warning(f"{failed_count} records failed to put to Kinesis for {source_name} batch")
-            logger.info(f"Sent {len(chunk)} records to Kinesis for {source_name}")
-        except (BotoCoreError, ClientError) as e:
-            logger.error(f"Error sending {source_name} records to Kinesis: {e}")
-            time.sleep(5)
+    # Partition keys are derived from trip_id, so trip_start and trip_end of a trip share a shard
+    records = aggregate_kinesis_records(batch)
+    logger.debug("Aggregated %d %s events into %d Kinesis records", len(batch), source_name, len(records))
+    failed_records = 0
+    failed_events = 0
+    for chunk in chunk_kinesis_records(records):
+        failed = put_records_with_retry(kinesis_client, stream_name, chunk, source_name)
+        logger.debug("Sent %d aggregated records to Kinesis for %s", len(chunk) - len(failed), source_name)
+        failed_records += len(failed)
+        # Each aggregated record carries one more event than it has newlines
+        failed_events += sum(record['Data'].count(b'\n') + 1 for record in failed)
+    with _send_stats_lock:
+        _send_stats[source_name, 'events'] += len(batch) - failed_events
+        _send_stats[source_name, 'sent'] += len(records) - failed_records
+        _send_stats[source_name, 'failed_events'] += failed_events
+        _send_stats[source_name, 'failed'] += failed_records
+
+
+def log_send_stats():
+    """Log and reset the per-source send counters accumulated since the last call."""
+    with _send_stats_lock:
+        stats = _send_stats.copy()
+        _send_stats.clear()
+    for source_name in sorted({source for source, _ in stats}):
+        logger.info(f"{source_name}: {stats[source_name, 'events']} events sent in "
+                    f"{stats[source_name, 'sent']} Kinesis records, {stats[source_name, 'failed_events']} events "
+                    f"in {stats[source_name, 'failed']} records failed")
+
+
+def run_send_stats_logger(stop_event):
+    """Log send stats every STATS_LOG_INTERVAL seconds until stop_event is set."""
+    while not stop_event.wait(STATS_LOG_INTERVAL):
+        log_send_stats()
+
+
+async def submit_batch(executor, inflight, batch, kinesis_client, stream_name, source_name):
+    """Send a batch on the executor, first waiting on the oldest batch once the in-flight cap is hit."""
+    if len(inflight) >= MAX_INFLIGHT_BATCHES:
+        await inflight.popleft()
+    loop = asyncio.get_running_loop()
+    inflight.append(loop.run_in_executor(executor, send_batch_to_kinesis, batch, kinesis_client, stream_name, source_name))
+
+
+async def stream_to_kinesis(generator, source_name, executor, inflight, kinesis_client, stream_name):
+    """Send every batch of one stream generator; the in-flight cap is shared with the other streams."""
+    async for batch in generator:
+        if batch:
+            await submit_batch(executor, inflight, batch, kinesis_client, stream_name, source_name)
+
+
+async def run_streams(streams, executor, kinesis_client, stream_name):
+    """Drive all (generator, source_name) streams concurrently, then drain the batches still in flight."""
+    inflight = deque()
+    try:
+        await asyncio.gather(*(
+            stream_to_kinesis(generator, source_name, executor, inflight, kinesis_client, stream_name)
+            for generator, source_name in streams
+        ))
+    finally:
+        for result in await asyncio.gather(*inflight, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending batch to Kinesis: {result}")
 
 
 if __name__ == "__main__":
     logger.info("Starting independent streaming of trip_start and trip_end to Kinesis Data Streams")
 
     try:
-        df_start = load_data(TRIP_START_CSV)
-        df_end = load_data(TRIP_END_CSV)
+        records_start = load_data(TRIP_START_CSV, TRIP_START_SCHEMA)
+        records_end = load_data(TRIP_END_CSV, TRIP_END_SCHEMA)
     except Exception:
         logger.critical("Failed to load data, exiting.")
         sys.exit(1)
@@ -175,27 +396,25 @@ if __name__ == "__main__":
         logger.critical("Failed to initialize Kinesis client, exiting.")
         sys.exit(1)
 
-    gen_start = data_stream_generator(df_start, "trip_start", base_rate=20, spike_chance=0.05, max_spike=100, outage_chance=0.1)
-    gen_end = data_stream_generator(df_end, "trip_end", base_rate=20, spike_chance=0.03, max_spike=50, outage_chance=0.15)
-
+    gen_start = data_stream_generator(records_start, "trip_start", base_rate=20, spike_chance=0.05, max_spike=100, outage_chance=0.1)
+    gen_end = data_stream_generator(records_end, "trip_end", base_rate=20, spike_chance=0.03, max_spike=50, outage_chance=0.15)
+    executor = ThreadPoolExecutor(max_workers=SEND_WORKERS)
+    stats_stop = threading.Event()
+    stats_thread = threading.Thread(target=run_send_stats_logger, args=(stats_stop,), daemon=True)
+    stats_thread.start()
 
     try:
-        while True:
-            batch_start = next(gen_start, None)
-            batch_end = next(gen_end, None)
-
-            if batch_start is None and batch_end is None:
-                logger.info("Both trip_start and trip_end streams exhausted. Exiting.")
-                break
-
-            if batch_start:
-                send_batch_to_kinesis(batch_start, kinesis_client, KINESIS_STREAM_NAME, "trip_start")
-            if batch_end:
-                send_batch_to_kinesis(batch_end, kinesis_client, KINESIS_STREAM_NAME, "trip_end")
-
+        # Both streams run on one event loop, so their sleeps and sends overlap
+        asyncio.run(run_streams([(gen_start, "trip_start"), (gen_end, "trip_end")], executor, kinesis_client, KINESIS_STREAM_NAME))
+        logger.info("Both trip_start and trip_end streams exhausted. Exiting.")
     except KeyboardInterrupt:
         logger.info("Streaming interrupted by user. Exiting gracefully.")
     except Exception as e:
         logger.error(f"Unexpected error: {e}", exc_info=True)
+    finally:
+        executor.shutdown()
+        stats_stop.set()
+        stats_thread.join()
+        log_send_stats()
 
 #test1
\ No newline at end of file
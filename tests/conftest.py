@@ -0,0 +1,60 @@
+import importlib.util
+import logging
+from pathlib import Path
+
+import pytest
+from moto import mock_aws
+
+SRC_DIR = Path(__file__).resolve().parent.parent / 'src'
+REGION = 'eu-north-1'
+
+
+def load_module(name, relative_path):
+    """Import a source file by path; the Lambda module is named lambda.py, so it cannot be imported normally."""
+    spec = importlib.util.spec_from_file_location(name, SRC_DIR / relative_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Fake credentials and a moto-mocked AWS account for the duration of a test."""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    monkeypatch.setenv('AWS_REGION', REGION)
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def glue(aws):
+    """Load the Glue job module with a fresh 'glue' logger and its project bucket."""
+    import boto3
+    boto3.client('s3').create_bucket(Bucket='lab7-stream-project', CreateBucketConfiguration={'LocationConstraint': REGION})
+    glue_logger = logging.getLogger('glue')
+    glue_logger.handlers.clear()
+    yield load_module('glue', 'glue/glue.py')
+    # Close handlers that received records while S3 is still mocked; otherwise
+    # logging.shutdown() would try to upload them to the real bucket at exit
+    for handler in list(glue_logger.handlers):
+        try:
+            handler.close()
+        except Exception:
+            pass
+        glue_logger.removeHandler(handler)
+
+
+@pytest.fixture
+def lambda_module(aws):
+    """Load the Lambda module against mocked DynamoDB."""
+    return load_module('trip_lambda', 'lambda/lambda.py')
+
+
+@pytest.fixture
+def simulator(aws, monkeypatch, tmp_path):
+    """Load the stream simulator, writing its log file under a temporary directory."""
+    monkeypatch.setenv('KINESIS_STREAM_NAME', 'trips')
+    monkeypatch.chdir(tmp_path)
+    return load_module('stream_simulate', 'stream_simulator/stream_simulate.py')
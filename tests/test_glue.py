@@ -0,0 +1,120 @@
+import gzip
+import logging
+import os
+
+import boto3
+import pandas as pd
+import pytest
+
+from conftest import load_module
+
+BUCKET = 'lab7-stream-project'
+
+
+def dynamodb_item(trip_id, dropoff_datetime, fare_amount='10.5'):
+    item = {field: {'S': 'x'} for field in ('pickup_location_id', 'dropoff_location_id', 'vendor_id',
+                                            'pickup_datetime', 'payment_type', 'trip_distance')}
+    item.update(trip_id={'S': trip_id}, dropoff_datetime={'S': dropoff_datetime}, fare_amount={'N': fare_amount})
+    return item
+
+
+def read_log_object(key):
+    response = boto3.client('s3').get_object(Bucket=BUCKET, Key=key)
+    assert response['ContentEncoding'] == 'gzip'
+    return gzip.decompress(response['Body'].read()).decode('utf-8')
+
+
+def test_handlers_attached_once_per_process(glue):
+    load_module('glue_reloaded', 'glue/glue.py')
+    # Ignore the capture handlers pytest's logging plugin attaches to every logger
+    handlers = [h for h in logging.getLogger('glue').handlers if not type(h).__module__.startswith('_pytest')]
+    assert [h.name for h in handlers].count(glue.S3_LOG_HANDLER_NAME) == 1
+    assert sum(type(h) is logging.StreamHandler for h in handlers) == 1
+    assert len(handlers) == 2
+    assert not logging.getLogger('glue').propagate
+
+
+def test_log_handler_uploads_gzip_object_on_close(glue):
+    glue.logger.info("first line")
+    glue.logger.warning("second line")
+    glue.upload_logs_to_s3()
+
+    lines = read_log_object(glue.log_handler.key).splitlines()
+    assert lines[0].endswith("INFO - first line")
+    assert lines[1].endswith("WARNING - second line")
+
+
+def test_log_handler_streams_full_parts(glue):
+    handler = glue.S3MultipartLogHandler(BUCKET, 'logs/glue/parts.log.gz')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    # Random hex barely compresses, so a few MB of it fill more than one part
+    messages = [os.urandom(512 * 1024).hex() for _ in range(12)]
+    for message in messages:
+        handler.emit(logging.makeLogRecord({'msg': message}))
+    assert handler.part_futures
+    handler.close()
+
+    assert read_log_object('logs/glue/parts.log.gz').splitlines() == messages
+
+
+def test_unused_log_handler_uploads_nothing_on_close(glue):
+    glue.log_handler.close()
+    assert 'Contents' not in boto3.client('s3').list_objects_v2(Bucket=BUCKET)
+
+
+def test_log_handler_makes_no_s3_calls_until_needed(glue):
+    # A missing bucket must not break construction; the failure surfaces on close()
+    handler = glue.S3MultipartLogHandler('missing-bucket', 'logs/glue/missing.log.gz', part_bytes=1)
+    assert handler.upload_id is None
+    handler.emit(logging.makeLogRecord({'msg': 'dropped'}))
+    assert handler.upload_error is not None
+    with pytest.raises(RuntimeError):
+        handler.close()
+
+
+def test_filter_completed_trips_buckets_by_local_date(glue):
+    items = [
+        dynamodb_item('offset', '2024-05-25T23:30:00-02:00'),
+        dynamodb_item('plain', '2024-05-25 20:30:00'),
+        dynamodb_item('zulu', '2024-05-26T01:00:00Z'),
+        dynamodb_item('garbage', 'not a date'),
+        dynamodb_item('trailing', '2024-05-25garbage'),
+        dynamodb_item('bad_time', '2024-05-25 99:99'),
+        dynamodb_item('free', '2024-05-25 10:00:00', fare_amount='0'),
+    ]
+    trips = glue.filter_completed_trips(items)
+    assert dict(zip(trips['trip_id'], trips['dropoff_date'])) == {
+        'offset': '2024-05-25',
+        'plain': '2024-05-25',
+        'zulu': '2024-05-26',
+    }
+
+
+def test_filter_completed_trips_skips_incomplete_items(glue):
+    incomplete = dynamodb_item('incomplete', '2024-05-25 20:30:00')
+    del incomplete['vendor_id']
+    blank = dynamodb_item('blank', '2024-05-25 20:30:00')
+    blank['payment_type'] = {'S': 'null'}
+    assert glue.filter_completed_trips([incomplete, blank]).empty
+
+
+def test_merge_daily_fares_combines_partials(glue):
+    first = glue.aggregate_daily_fares(pd.DataFrame({
+        'dropoff_date': ['2024-05-25', '2024-05-25', '2024-05-26'],
+        'fare_amount': [10.0, 30.0, 5.0],
+    }))
+    second = glue.aggregate_daily_fares(pd.DataFrame({
+        'dropoff_date': ['2024-05-25'],
+        'fare_amount': [2.0],
+    }))
+    kpis = glue.calculate_kpis(glue.merge_daily_fares([first, second]))
+    assert kpis['2024-05-25'] == {
+        'date': '2024-05-25',
+        'total_fare': 42.0,
+        'count_trips': 3,
+        'average_fare': 14.0,
+        'max_fare': 30.0,
+        'min_fare': 2.0,
+    }
+    assert kpis['2024-05-26']['count_trips'] == 1
+    assert glue.merge_daily_fares([]).empty
@@ -0,0 +1,128 @@
+import base64
+import json
+from decimal import Decimal
+
+
+def trip_start(trip_id):
+    return {
+        'trip_id': trip_id,
+        'pickup_location_id': 93,
+        'dropoff_location_id': 93,
+        'vendor_id': 1,
+        'pickup_datetime': '2024-05-25 13:19:00',
+        'estimated_dropoff_datetime': '2024-05-25 14:03:00',
+        'estimated_fare_amount': 34.18
+    }
+
+
+def trip_end(trip_id, fare_amount='40.09'):
+    # fare_amount is spliced in raw so tests can send numbers json.dumps cannot produce
+    return ('{"trip_id": "%s", "dropoff_datetime": "2024-05-25 14:05:00", "fare_amount": %s, '
+            '"payment_type": 3.0, "trip_distance": 0.1}' % (trip_id, fare_amount))
+
+
+def kinesis_event(*payloads):
+    """Build an event with one Kinesis record per payload; a payload may hold several newline-delimited events."""
+    return {'Records': [{'kinesis': {'data': base64.b64encode(payload.encode('utf-8')).decode('ascii')}}
+                        for payload in payloads]}
+
+
+def body(response):
+    return json.loads(response['body'])
+
+
+def get_trip(lambda_module, trip_id, table_name='TripData'):
+    return lambda_module.dynamodb_resource.Table(table_name).get_item(Key={'trip_id': trip_id}).get('Item')
+
+
+def test_aggregated_record_is_split_and_merged_per_trip(lambda_module):
+    aggregate = '\n'.join([json.dumps(trip_start('a')), trip_end('a'), '', json.dumps(trip_start('b'))])
+    response = lambda_module.lambda_handler(kinesis_event(aggregate), None)
+
+    assert body(response) == 'Successfully processed 3 records, logged 0 errors, 0 failures'
+    trip = get_trip(lambda_module, 'a')
+    assert trip['vendor_id'] == Decimal('1')
+    assert trip['fare_amount'] == Decimal('40.09')
+    assert get_trip(lambda_module, 'b')['pickup_location_id'] == Decimal('93')
+
+
+def test_events_merge_with_stored_item_across_invocations(lambda_module):
+    lambda_module.lambda_handler(kinesis_event(json.dumps(trip_start('a'))), None)
+    lambda_module.lambda_handler(kinesis_event(trip_end('a')), None)
+
+    trip = get_trip(lambda_module, 'a')
+    assert trip['pickup_datetime'] == '2024-05-25 13:19:00'
+    assert trip['dropoff_datetime'] == '2024-05-25 14:05:00'
+
+
+def record_read_params(lambda_module):
+    """Capture the request parameters of every GetItem/BatchGetItem call the Lambda makes."""
+    calls = []
+    events = lambda_module.dynamodb_resource.meta.client.meta.events
+    for operation in ('GetItem', 'BatchGetItem'):
+        events.register(f'provide-client-params.dynamodb.{operation}',
+                        lambda params, operation=operation, **kwargs: calls.append((operation, params)))
+    return calls
+
+
+def test_trip_merge_reads_are_strongly_consistent(lambda_module, monkeypatch):
+    lambda_module.lambda_handler(kinesis_event(json.dumps(trip_start('a'))), None)
+    calls = record_read_params(lambda_module)
+    lambda_module.lambda_handler(kinesis_event(trip_end('a')), None)
+    assert [params['RequestItems']['TripData']['ConsistentRead'] for _, params in calls] == [True]
+
+    # The per-item fallback reads must be consistent too
+    calls.clear()
+    def fail_batch_get(**kwargs):
+        raise RuntimeError("batch read failed")
+    monkeypatch.setattr(lambda_module.dynamodb_resource, 'batch_get_item', fail_batch_get)
+    lambda_module.lambda_handler(kinesis_event(trip_end('a')), None)
+    assert calls == [('GetItem', {'TableName': 'TripData', 'Key': {'trip_id': 'a'}, 'ConsistentRead': True})]
+    assert get_trip(lambda_module, 'a')['vendor_id'] == Decimal('1')
+
+
+def test_malformed_line_only_fails_its_own_event(lambda_module):
+    aggregate = '\n'.join([trip_end('a'), '{not json', trip_end('b')])
+    response = lambda_module.lambda_handler(kinesis_event(aggregate), None)
+
+    assert body(response) == 'Successfully processed 2 records, logged 0 errors, 1 failures'
+    assert get_trip(lambda_module, 'a') and get_trip(lambda_module, 'b')
+
+
+def test_invalid_events_go_to_error_table(lambda_module):
+    missing_vendor = trip_start('a')
+    missing_vendor['vendor_id'] = None
+    nan_payment = trip_end('b').replace('3.0', 'NaN')
+    response = lambda_module.lambda_handler(kinesis_event(json.dumps(missing_vendor), nan_payment), None)
+
+    assert body(response) == 'Successfully processed 0 records, logged 2 errors, 0 failures'
+    error = get_trip(lambda_module, 'b', 'TripDataErrors')
+    assert error['error_reasons'] == ["Missing, null, or blank required field 'payment_type' in trip_end"]
+    assert error['original_data']['payment_type'] is None
+
+
+def test_error_lists_merge_with_consistent_reads(lambda_module):
+    invalid = trip_end('b').replace('3.0', 'null')
+    lambda_module.lambda_handler(kinesis_event(invalid), None)
+    calls = record_read_params(lambda_module)
+    lambda_module.lambda_handler(kinesis_event(invalid), None)
+
+    assert [params['RequestItems']['TripDataErrors']['ConsistentRead'] for _, params in calls] == [True]
+    assert len(get_trip(lambda_module, 'b', 'TripDataErrors')['error_reasons']) == 2
+
+
+def test_high_precision_floats_are_rounded_to_dynamodb_precision(lambda_module):
+    response = lambda_module.lambda_handler(kinesis_event(trip_end('a', '1.' + '1' * 40)), None)
+
+    assert body(response) == 'Successfully processed 1 records, logged 0 errors, 0 failures'
+    assert get_trip(lambda_module, 'a')['fare_amount'] == Decimal('1.' + '1' * 37)
+
+
+def test_unwritable_item_does_not_drop_the_rest_of_the_batch(lambda_module):
+    # 1e200 is outside DynamoDB's number range, so the whole BatchWriteItem request fails
+    aggregate = '\n'.join([trip_end(f'good-{i}') for i in range(5)] + [trip_end('bad', '1e200')])
+    response = lambda_module.lambda_handler(kinesis_event(aggregate), None)
+
+    assert body(response) == 'Successfully processed 5 records, logged 0 errors, 1 failures'
+    assert all(get_trip(lambda_module, f'good-{i}') for i in range(5))
+    assert get_trip(lambda_module, 'bad') is None
@@ -0,0 +1,115 @@
+import json
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+
+class FakeKinesis:
+    """Kinesis stand-in that returns scripted put_records outcomes and records each call."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def put_records(self, StreamName, Records):
+        self.calls.append(list(Records))
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if isinstance(outcome, Exception):
+            raise outcome
+        error_codes = outcome or [None] * len(Records)
+        return {
+            'FailedRecordCount': sum(code is not None for code in error_codes),
+            'Records': [{'ErrorCode': code} if code else {'SequenceNumber': '1'} for code in error_codes]
+        }
+
+
+@pytest.fixture
+def sleeps(simulator, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(simulator.time, 'sleep', recorded.append)
+    return recorded
+
+
+def event(simulator, trip_id, padding=''):
+    prefix = json.dumps({'trip_id': trip_id, 'padding': padding}).encode('utf-8')[:-1] + b',"event_timestamp":"'
+    return simulator.partition_key_for(trip_id), prefix, b'2024-05-25T00:00:00Z"}'
+
+
+def test_partition_key_is_stable_per_trip(simulator):
+    assert simulator.partition_key_for('c66ce556bc') == simulator.partition_key_for('c66ce556bc')
+    assert simulator.partition_key_for('c66ce556bc') in simulator.PK_POOL
+
+
+def test_aggregates_are_newline_delimited_and_capped(simulator):
+    batch = [event(simulator, f'trip-{i}', 'x' * 3000) for i in range(40)]
+    records = simulator.aggregate_kinesis_records(batch)
+
+    assert all(len(record['Data']) <= simulator.MAX_AGGREGATE_BYTES for record in records)
+    decoded = [json.loads(line) for record in records for line in record['Data'].split(b'\n')]
+    assert sorted(item['trip_id'] for item in decoded) == sorted(f'trip-{i}' for i in range(40))
+    assert all(item['event_timestamp'] == '2024-05-25T00:00:00Z' for item in decoded)
+    for record in records:
+        keys = {simulator.partition_key_for(json.loads(line)['trip_id']) for line in record['Data'].split(b'\n')}
+        assert keys == {record['PartitionKey']}
+
+
+def test_oversized_event_gets_its_own_record(simulator):
+    batch = [event(simulator, 'big', 'x' * simulator.MAX_AGGREGATE_BYTES), event(simulator, 'big')]
+    records = simulator.aggregate_kinesis_records(batch)
+    assert [record['Data'].count(b'\n') for record in records] == [0, 0]
+
+
+def test_chunks_respect_put_records_limits(simulator):
+    records = [{'Data': b'x', 'PartitionKey': '1'}] * (simulator.MAX_RECORDS_PER_PUT + 1)
+    assert [len(chunk) for chunk in simulator.chunk_kinesis_records(records)] == [simulator.MAX_RECORDS_PER_PUT, 1]
+
+
+def test_put_retries_only_failed_entries(simulator, sleeps):
+    client = FakeKinesis(
+        ClientError({'Error': {'Code': 'InternalFailure'}}, 'PutRecords'),
+        [simulator.THROTTLING_ERROR_CODE, None, 'InternalFailure'],
+        [None, 'InternalFailure'],
+    )
+    chunk = [{'Data': bytes([i]), 'PartitionKey': '1'} for i in range(3)]
+    assert simulator.put_records_with_retry(client, 'trips', chunk, 'trip_end') == []
+
+    assert [[record['Data'] for record in call] for call in client.calls] == [
+        [b'\x00', b'\x01', b'\x02'], [b'\x00', b'\x01', b'\x02'], [b'\x00', b'\x02'], [b'\x02']
+    ]
+    # Backs off after the failed call and the throttled entry, not after the plain entry failure
+    assert len(sleeps) == 2
+
+
+def test_put_gives_up_after_max_retries(simulator, sleeps):
+    client = FakeKinesis(*[['InternalFailure']] * (simulator.MAX_PUT_RETRIES + 1))
+    chunk = [{'Data': b'x', 'PartitionKey': '1'}]
+    assert simulator.put_records_with_retry(client, 'trips', chunk, 'trip_end') == chunk
+    assert len(client.calls) == simulator.MAX_PUT_RETRIES + 1
+
+
+def test_send_batch_delivers_every_event(simulator):
+    kinesis = boto3.client('kinesis')
+    kinesis.create_stream(StreamName='trips', ShardCount=1)
+    batch = [event(simulator, f'trip-{i}') for i in range(30)]
+    simulator.send_batch_to_kinesis(batch, kinesis, 'trips', 'trip_end')
+
+    shard_id = kinesis.list_shards(StreamName='trips')['Shards'][0]['ShardId']
+    iterator = kinesis.get_shard_iterator(StreamName='trips', ShardId=shard_id, ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+    records = kinesis.get_records(ShardIterator=iterator)['Records']
+    trip_ids = [json.loads(line)['trip_id'] for record in records for line in record['Data'].split(b'\n')]
+    assert sorted(trip_ids) == sorted(f'trip-{i}' for i in range(30))
+
+
+def test_send_stats_exclude_events_in_failed_records(simulator, sleeps):
+    batch = [event(simulator, 'a'), event(simulator, 'a'), event(simulator, 'b')]
+    failed_key = simulator.partition_key_for('a')
+    records = simulator.aggregate_kinesis_records(batch)
+    error_codes = [['InternalFailure' if record['PartitionKey'] == failed_key else None for record in records]]
+    error_codes += [['InternalFailure']] * simulator.MAX_PUT_RETRIES
+    simulator._send_stats.clear()
+    simulator.send_batch_to_kinesis(batch, FakeKinesis(*error_codes), 'trips', 'trip_end')
+
+    assert simulator._send_stats['trip_end', 'events'] == 1
+    assert simulator._send_stats['trip_end', 'failed_events'] == 2
+    assert simulator._send_stats['trip_end', 'failed'] == 1